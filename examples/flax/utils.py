@@ -9,43 +9,105 @@
 ####################################################################################
 
 
-import math
-from typing import Callable, Generator, Optional
+import queue
+import threading
+from typing import Callable, Generator, Iterator, Optional, Sequence, Union
 
 import jax
 import numpy as np
 from datasets import Dataset
 
 
+def prefetch(iterator: Iterator, size: int = 2, devices: Optional[Sequence] = None) -> Generator[dict, None, None]:
+    """
+    Prefetches `size` batches from `iterator` onto the device via `jax.device_put`, overlapping host-side batch preparation with accelerator compute. Batches are produced by a background thread feeding a bounded queue. Exceptions raised while producing a batch are re-raised in the consumer, and a consumer that stops iterating early shuts the producer down.
+    """  # noqa
+    device = (devices or jax.devices())[0]
+    batch_queue = queue.Queue(maxsize=size)
+    sentinel = object()
+    stopped = threading.Event()
+
+    def _put(item):
+        # Bounded put that gives up once the consumer is gone, so the
+        # producer thread never blocks forever on a full queue.
+        while not stopped.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for batch in iterator:
+                batch = jax.tree_util.tree_map(lambda x: jax.device_put(x, device), batch)
+                if not _put(batch):
+                    return
+        except Exception as exc:  # noqa: BLE001 - hand the error to the consumer
+            _put(exc)
+        else:
+            _put(sentinel)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            batch = batch_queue.get()
+            if batch is sentinel:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stopped.set()
+
+
 def data_loader(
-    rng: jax.random.PRNGKey,
+    rng: Union[int, jax.random.PRNGKey],
     dataset: Dataset,
     batch_size: int,
     shuffle: bool = False,
     drop_last: bool = False,
     transform_fn: Optional[Callable] = None,
+    prefetch_size: int = 0,
 ) -> Generator[dict, None, None]:
     """
-    Returns batches of size `batch_size` from `dataset`. If `drop_last` is set to `False`, the final batch may be incomplete, and range in size from 1 to `batch_size`. Shuffle batches if `shuffle` is `True`.
+    Returns batches of size `batch_size` from `dataset`. If `drop_last` is set to `False`, the final batch may be incomplete, and range in size from 1 to `batch_size`. Shuffle batches if `shuffle` is `True`. If `prefetch_size` is positive, that many upcoming batches are prepared in a background thread and placed on the device ahead of time.
     """  # noqa
+    # Let HF datasets hand back NumPy arrays directly instead of re-copying
+    # every column through Python lists on each batch.
+    dataset = dataset.with_format("numpy")
+
     if shuffle:
-        batch_idx = jax.random.permutation(rng, len(dataset))
-        batch_idx = np.asarray(batch_idx)
+        # Shuffling is CPU-bound bookkeeping: do it in NumPy rather than
+        # dispatching an XLA permutation kernel and syncing with the device.
+        seed = rng if isinstance(rng, int) else int(jax.random.randint(rng, (), 0, 2**31 - 1))
+        batch_idx = np.random.default_rng(seed).permutation(len(dataset))
     else:
         batch_idx = np.arange(len(dataset))
 
+    batch_idx = np.ascontiguousarray(batch_idx, dtype=np.int64)
+
     if drop_last:
         steps_per_epoch = len(dataset) // batch_size
         batch_idx = batch_idx[: steps_per_epoch * batch_size]  # Skip incomplete batch.
         batch_idx = batch_idx.reshape((steps_per_epoch, batch_size))
     else:
-        steps_per_epoch = math.ceil(len(dataset) / batch_size)
-        batch_idx = np.array_split(batch_idx, steps_per_epoch)
+        # Slice the index array directly; np.array_split returns a Python
+        # list of per-batch copies.
+        offsets = np.arange(0, len(dataset), batch_size)
+        batch_idx = [batch_idx[start : start + batch_size] for start in offsets]
+
+    def generate():
+        for idx in batch_idx:
+            batch = dataset[idx]
+            if transform_fn is not None:
+                batch = transform_fn(batch)
 
-    for idx in batch_idx:
-        batch = dataset[idx]
-        if transform_fn is not None:
-            batch = transform_fn(batch)
-        batch = {k: np.array(v) for k, v in batch.items()}
+            yield batch
 
-        yield batch
+    if prefetch_size > 0:
+        return prefetch(generate(), size=prefetch_size)
+    return generate()
@@ -5,12 +5,12 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import math
 from typing import NamedTuple
 
 import chex
 import jax
 import jax.numpy as jnp
-import numpy as np
 import optax
 from optax import adafactor, adamw, lion, sgd
 from optax._src import utils as optax_utils
@@ -19,15 +19,21 @@ from flora_opt.optimizers.optax.flora import flora
 from flora_opt.optimizers.optax.utils import (
     NaiveDecomposition,
     TwoSideRandomDecomposition,
-    random_split_like_tree,
 )
 
 
 def random_generate(key: chex.PRNGKey, shape: chex.Shape, dtype: chex.ArrayDType = None):
-    return jax.random.normal(key, shape, dtype=dtype) / jnp.sqrt(min(shape))
+    return jax.random.normal(key, shape, dtype=dtype) * (1.0 / math.sqrt(min(shape)))
 
 
 class GradAccState(NamedTuple):
+    """State carried across gradient-accumulation ministeps.
+
+    accumulate_update preserves the structure, shapes and dtypes of every
+    field, so the state is safe to donate (or carry through lax.fori_loop,
+    as the flax examples do) and have XLA reuse its buffers in place.
+    """
+
     decomposition: chex.ArrayTree
     rng: chex.PRNGKey
 
@@ -39,32 +45,48 @@ def compressed_acc(
     side: str = "auto",
     min_dim_size_to_factor: int = 128,
 ):
+    # Both decisions below are static functions of the parameter shape; they
+    # are resolved once per shape instead of inside every traced closure.
+    _factorize_cache = {}
+
     def should_factorize(params):
+        shape = tuple(params.shape)
+        if shape in _factorize_cache:
+            return _factorize_cache[shape]
+
         if factored is False:
-            return False
-        if params.ndim != 2:
-            return False
-        if max(params.shape) > min(params.shape) * 16:
+            decision = False
+        elif params.ndim != 2:
+            decision = False
+        elif max(shape) > min(shape) * 16:
             # filter out embeddings
-            return False
-        return min(params.shape) >= min_dim_size_to_factor
-        return True
+            decision = False
+        else:
+            decision = min(shape) >= min_dim_size_to_factor
+
+        _factorize_cache[shape] = decision
+        return decision
+
+    def decide_side(ind, outd):
+        if side == "auto":
+            return "right" if outd > ind else "left"
+        return side
 
     mu_dtype = optax_utils.canonicalize_dtype(jnp.float32)
 
     def accumulate_init(state):
-        prngkey_tree = random_split_like_tree(state.dropout_rng, state.params)
+        leaves, treedef = jax.tree_util.tree_flatten(state.params)
+        keys = jax.random.split(state.dropout_rng, treedef.num_leaves)
 
         def _fn(p, k):
             if should_factorize(p):
-                shape = np.array(p.shape)
-                ind, outd = shape
+                ind, outd = p.shape
                 l_key, r_key = jax.random.split(k, 2)
                 otau = itau = tau
-                if side == "auto":
-                    _side = "right" if outd > ind else "left"
-                else:
-                    _side = side
+                _side = decide_side(ind, outd)
+                # Only the keys go into the carry; the projections are
+                # regenerated as jit-internal temporaries each ministep so
+                # they never stay live across the accumulation window.
                 return TwoSideRandomDecomposition(
                     r_data=jnp.zeros((outd, otau), dtype=mu_dtype) if _side != "left" else None,
                     r_proj=r_key if _side != "left" else None,
@@ -77,7 +99,7 @@ def compressed_acc(
                 )
 
         return GradAccState(
-            decomposition=jax.tree_map(_fn, state.params, prngkey_tree),
+            decomposition=jax.tree_util.tree_unflatten(treedef, [_fn(p, keys[i]) for i, p in enumerate(leaves)]),
             rng=None,
         )
 
@@ -90,24 +112,21 @@ def compressed_acc(
         def _full_layer_fn(grad, dcomp):
             if not should_factorize(grad):
                 return _naive_fn(grad, dcomp)
-            shape = np.array(grad.shape)
-            ind, outd = shape
+            ind, outd = grad.shape
             otau = itau = tau
+            _side = decide_side(ind, outd)
 
-            if side == "auto":
-                _side = "right" if outd > ind else "left"
-            else:
-                _side = side
-
+            # Contract with einsum so the transposes stay implicit in the
+            # dot_general instead of materializing transposed copies.
             def l_proj_fn(m):
                 if _side == "right":
                     return None
-                return random_generate(dcomp.l_proj, (outd, itau), mu_dtype).T @ m.T
+                return jnp.einsum("ot,io->ti", random_generate(dcomp.l_proj, (outd, itau), mu_dtype), m)
 
             def r_proj_fn(m):
                 if _side == "left":
                     return None
-                return m.T @ random_generate(dcomp.r_proj, (otau, ind), mu_dtype).T
+                return jnp.einsum("io,ti->ot", m, random_generate(dcomp.r_proj, (otau, ind), mu_dtype))
 
             l_data = dcomp.l_data if _side != "right" else None
             r_data = dcomp.r_data if _side != "left" else None
@@ -140,14 +159,9 @@ def compressed_acc(
             if isinstance(dcomp, NaiveDecomposition):
                 return _naive_fn(dcomp, p)
 
-            shape = np.array(p.shape)
-            ind, outd = shape
+            ind, outd = p.shape
             otau = itau = tau
-
-            if side == "auto":
-                _side = "right" if outd > ind else "left"
-            else:
-                _side = side
+            _side = decide_side(ind, outd)
 
             r_proj = random_generate(dcomp.r_proj, (otau, ind), mu_dtype) if _side != "left" else None
             l_proj = random_generate(dcomp.l_proj, (outd, itau), mu_dtype) if _side != "right" else None
@@ -5,7 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 
-from functools import partial
+import math
 from typing import Any, NamedTuple, Optional
 
 import chex
@@ -18,21 +18,16 @@ from flora_opt.optimizers.optax.utils import (
     NaiveDecomposition,
     RandomDecomposition,
     next_rng_key,
-    random_orthogonal,
-    random_split_like_tree,
     scale_by_learning_rate,
 )
 
 
 def random_generate(key: chex.PRNGKey, shape: chex.Shape, dtype: chex.ArrayDType = jnp.float32) -> chex.Array:
-    orth = False
-    if orth:
-        return random_orthogonal(key, shape, dtype)
-    else:
-        return jax.random.normal(key, shape, dtype=dtype) / jnp.sqrt(min(shape))
+    # The scale is static, so fold it into a single fused multiply rather
+    # than emitting a traced sqrt and divide.
+    return jax.random.normal(key, shape, dtype=dtype) * (1.0 / math.sqrt(min(shape)))
 
 
-@partial(jax.remat, policy=jax.checkpoint_policies.nothing_saveable, static_argnums=(2,))
 def down_project(rng: chex.PRNGKey, x: chex.Array, tau: int) -> chex.Array:
     if x.shape[0] < x.shape[-1]:
         proj = random_generate(rng, (tau, x.shape[0]), x.dtype)
@@ -42,7 +37,6 @@ def down_project(rng: chex.PRNGKey, x: chex.Array, tau: int) -> chex.Array:
         return jnp.dot(x, proj)
 
 
-@partial(jax.remat, policy=jax.checkpoint_policies.nothing_saveable, static_argnums=(2, 3))
 def up_project(rng: chex.PRNGKey, x: chex.Array, tau: int, shape: chex.Shape) -> chex.Array:
     if shape[0] < shape[-1]:
         proj = random_generate(rng, (tau, shape[0]), x.dtype)
@@ -65,6 +59,7 @@ def flora(
     eps: float = 1e-30,
     min_dim_size_to_factor: int = 128,
     factorized_second_moment: bool = True,
+    mu_dtype: Optional[chex.ArrayDType] = jnp.bfloat16,
 ) -> optax.GradientTransformation:
     tx = [
         scale_by_flora(
@@ -74,6 +69,7 @@ def flora(
             seed=seed,
             kappa=kappa,
             min_dim_size_to_factor=min_dim_size_to_factor,
+            mu_dtype=mu_dtype,
         )
     ]
     import optax._src.factorized
@@ -103,21 +99,19 @@ def flora(
     def init_fn(params):
         return tuple(fn(params) for fn in init_fns)
 
+    # update_fn is pure in `state` and returns a pytree with the same
+    # structure, shapes and dtypes, so callers may jit their train step with
+    # donate_argnums on the optimizer state and let XLA reuse its buffers.
     def update_fn(updates, state, params=None, **extra_args):
         if len(update_fns) != len(state):
             raise ValueError(
                 "The number of updates and states has to be the same in " "chain! Make sure you have called init first!"
             )
 
+        # Single composed pass over the chain; under jit this unrolls into
+        # one traced function with no per-transformation Python dispatch.
         new_state = []
-
-        updates, new_s = update_fns[0](updates, state[0], params, **extra_args)
-        new_state.append(new_s)
-
-        updates, new_s = update_fns[1](updates, state[1], params, **extra_args)
-        new_state.append(new_s)
-
-        for s, fn in zip(state[2:], update_fns[2:]):
+        for s, fn in zip(state, update_fns):
             updates, new_s = fn(updates, s, params, **extra_args)
             new_state.append(new_s)
         return updates, tuple(new_state)
@@ -125,8 +119,19 @@ def flora(
     return base.GradientTransformationExtraArgs(init_fn, update_fn)
 
 
+class _LayerUpdate(NamedTuple):
+    """Per-layer result of the fused Flora update."""
+
+    decomposition: Any
+    update: chex.Array
+
+
 class ScaleByFloraState(NamedTuple):
-    """State for the Flora algorithm."""
+    """State for the Flora algorithm.
+
+    The update step preserves the structure, shapes and dtypes of every
+    field, which makes the state safe to donate to a jitted train step.
+    """
 
     count: chex.Array  # shape=(), dtype=jnp.int32.
     decomposition: chex.ArrayTree
@@ -140,22 +145,49 @@ def scale_by_flora(
     seed: int = 0,
     kappa: int = 1000,
     min_dim_size_to_factor: int = 128,
+    mu_dtype: Optional[chex.ArrayDType] = jnp.bfloat16,
 ) -> optax.GradientTransformation:
+    # The factorization decision only depends on the (static) shape, so it is
+    # resolved once per shape here rather than on every traced update.
+    _factorize_cache = {}
+
     def should_factorize(params):
+        shape = tuple(params.shape)
+        if shape in _factorize_cache:
+            return _factorize_cache[shape]
+
+        decision = True
         if factored is False:
-            return False
-        if params.ndim != 2:
-            return False
-        if max(params.shape) > min(params.shape) * 4:
+            decision = False
+        elif params.ndim != 2:
+            decision = False
+        elif max(shape) > min(shape) * 4:
             # do not factorize embeddings
-            return False
-        return min(params.shape) >= min_dim_size_to_factor
+            decision = False
+        else:
+            decision = min(shape) >= min_dim_size_to_factor
+
+        _factorize_cache[shape] = decision
+        return decision
+
+    # Accumulator (and therefore projection) precision; bf16 by default to
+    # halve the memory held by the decomposition state.
+    mu_dtype = utils.canonicalize_dtype(mu_dtype)
 
-    mu_dtype = utils.canonicalize_dtype(jnp.bfloat16)
+    # Resolve the EMA coefficients once so the traced closures embed a single
+    # shared constant rather than re-deriving 1 - beta at every use site.
+    one_minus_beta = None if beta is None else 1 - beta
+
+    # The root key only depends on the static seed; build it once here rather
+    # than inside init_fn.
+    root_rng = jax.random.PRNGKey(seed)
 
     def init_fn(params):
-        rng = jax.random.PRNGKey(seed)
-        prngkey_tree = random_split_like_tree(rng, params)
+        rng = root_rng
+        # One split for all leaves, indexed directly; no intermediate key
+        # pytree is built.
+        leaves, treedef = jax.tree_util.tree_flatten(params)
+        keys = jax.random.split(rng, treedef.num_leaves)
 
         def _init_layer(params, key):
             if should_factorize(params):
@@ -171,62 +203,96 @@ def scale_by_flora(
 
         return ScaleByFloraState(
             count=jnp.zeros([], jnp.int32),
-            decomposition=jax.tree_map(_init_layer, params, prngkey_tree),
+            decomposition=jax.tree_util.tree_unflatten(
+                treedef, [_init_layer(p, keys[i]) for i, p in enumerate(leaves)]
+            ),
             rng=rng,
         )
 
-    def update_state(grads, state, params=None):
-        grads = jax.tree_map(lambda x: x.astype(mu_dtype), grads)
+    def update_fn(grads: Any, state: ScaleByFloraState, params: Any = None):
+        del params
 
-        @partial(jax.remat, policy=jax.checkpoint_policies.nothing_saveable, static_argnums=(0,))
+        # No remat here: the optimizer update is never differentiated, so
+        # checkpointing it only adds tracing overhead and recomputation.
         def _maybe_switch_proj_fn(shape, dcomp):
             flag = jnp.mod(state.count, kappa) == 0
-            return RandomDecomposition(
-                data=jax.lax.cond(
-                    flag,
-                    lambda: down_project(dcomp.proj, up_project(dcomp.proj, dcomp.data, tau, shape), tau),
-                    lambda: dcomp.data,
-                ),
-                proj=jax.lax.cond(
-                    flag,
-                    lambda: next_rng_key(dcomp.proj),
-                    lambda: dcomp.proj,
-                ),
-            )
+
+            def _switch_fn():
+                return RandomDecomposition(
+                    data=down_project(dcomp.proj, up_project(dcomp.proj, dcomp.data, tau, shape), tau),
+                    proj=next_rng_key(dcomp.proj),
+                )
+
+            # A single cond over the (data, proj) pair instead of one cond per
+            # field, so each layer dispatches one branch per step.
+            return jax.lax.cond(flag, _switch_fn, lambda: dcomp)
 
         def _update_layer_fn(grad, dcomp):
+            # Cast leaf-by-leaf so XLA fuses the cast into the consuming op,
+            # instead of materializing a second low-precision gradient tree.
+            mu_grad = grad.astype(mu_dtype)
             if not should_factorize(grad):
-                return NaiveDecomposition(data=beta * dcomp.data + (1 - beta) * grad)
-
-            dcomp = _maybe_switch_proj_fn(grad.shape, dcomp)
-            return RandomDecomposition(
-                data=dcomp.data * beta + (1 - beta) * down_project(dcomp.proj, grad, tau),
-                proj=dcomp.proj,
+                # Incremental EMA form: one multiply instead of two, and XLA
+                # fuses the whole expression into a single kernel.
+                dcomp = NaiveDecomposition(data=dcomp.data + one_minus_beta * (mu_grad - dcomp.data))
+                query = dcomp.data
+            else:
+                dcomp = _maybe_switch_proj_fn(grad.shape, dcomp)
+                # Draw the projection once and share it between the compressed
+                # accumulator update and the decompressed query.
+                if grad.shape[0] < grad.shape[-1]:
+                    proj = random_generate(dcomp.proj, (tau, grad.shape[0]), mu_grad.dtype)
+                    data = dcomp.data * beta + one_minus_beta * jnp.dot(proj, mu_grad)
+                    query = jnp.dot(proj.T, data)
+                else:
+                    proj = random_generate(dcomp.proj, (grad.shape[-1], tau), mu_grad.dtype)
+                    data = dcomp.data * beta + one_minus_beta * jnp.dot(mu_grad, proj)
+                    query = jnp.dot(data, proj.T)
+                dcomp = RandomDecomposition(data=data, proj=dcomp.proj)
+            # The final interpolation with the raw gradient happens here too,
+            # so the whole update is a single traversal of the pytree.
+            return _LayerUpdate(decomposition=dcomp, update=query * beta + grad * one_minus_beta)
+
+        grad_leaves, grads_treedef = jax.tree_util.tree_flatten(grads)
+        dcomp_leaves = grads_treedef.flatten_up_to(state.decomposition)
+
+        # Batch factorized layers that share a shape and dtype through one
+        # vmapped call, so their projection draws and matmuls run as single
+        # batched kernels instead of one dispatch per layer. vmap guarantees
+        # the same per-layer values as the unbatched path.
+        groups = {}
+        for i, grad in enumerate(grad_leaves):
+            if should_factorize(grad):
+                groups.setdefault((grad.shape, grad.dtype), []).append(i)
+
+        output_leaves = [None] * len(grad_leaves)
+        vmapped_layer_fn = jax.vmap(_update_layer_fn)
+        for indices in groups.values():
+            if len(indices) < 2:
+                continue
+            stacked = vmapped_layer_fn(
+                jnp.stack([grad_leaves[i] for i in indices]),
+                RandomDecomposition(
+                    data=jnp.stack([dcomp_leaves[i].data for i in indices]),
+                    proj=jnp.stack([dcomp_leaves[i].proj for i in indices]),
+                ),
             )
+            for j, i in enumerate(indices):
+                output_leaves[i] = jax.tree_map(lambda x: x[j], stacked)
 
-        decomposition = jax.tree_map(_update_layer_fn, grads, state.decomposition)
+        for i, grad in enumerate(grad_leaves):
+            if output_leaves[i] is None:
+                output_leaves[i] = _update_layer_fn(grad, dcomp_leaves[i])
 
-        return ScaleByFloraState(
+        output = jax.tree_util.tree_unflatten(grads_treedef, output_leaves)
+        is_result = lambda x: isinstance(x, _LayerUpdate)  # noqa: E731
+
+        state = ScaleByFloraState(
             count=state.count + 1,
-            decomposition=decomposition,
+            decomposition=jax.tree_map(lambda o: o.decomposition, output, is_leaf=is_result),
             rng=state.rng,
         )
-
-    def query(grads: Any, state: ScaleByFloraState, params: Any = None):
-        def _layer_fn(grad, dcomp):
-            if not should_factorize(grad):
-                return dcomp.data
-            else:
-                return up_project(dcomp.proj, dcomp.data, tau, grad.shape)
-
-        return jax.tree_map(_layer_fn, grads, state.decomposition)
-
-    def update_fn(grads: Any, state: ScaleByFloraState, params: Any = None):
-        del params
-
-        state = update_state(grads, state)
-        updates = query(grads, state)
-        updates = jax.tree_map(lambda m, g: m * beta + g * (1 - beta), updates, grads)
+        updates = jax.tree_map(lambda o: o.update, output, is_leaf=is_result)
 
         return updates, state
 
@@ -237,11 +303,13 @@ def scale_by_interp(
     weight: float = 0.9,
     transform_fn: Optional[callable] = None,
 ) -> optax.GradientTransformation:
+    one_minus_weight = 1 - weight
+
     def init_fn(params):
         return base.EmptyState()
 
     def update_fn(grads, state, params=None, updates=None):
-        updates = jax.tree_map(lambda g, u: (1 - weight) * g + weight * u, grads, updates)
+        updates = jax.tree_map(lambda g, u: one_minus_weight * g + weight * u, grads, updates)
         if transform_fn is not None:
             updates = jax.tree_map(transform_fn, updates)
         return updates, state
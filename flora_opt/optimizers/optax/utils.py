@@ -153,7 +153,11 @@ def scale_by_factored_rms(
         return _to_state(jnp.zeros([], jnp.int32), jax.tree_util.tree_map(_init, params))
 
     def update_fn(grads, state, params, updates, query_only=False, **kwargs):
-        """Apply gradient transformation."""
+        """Apply gradient transformation.
+
+        The returned state mirrors the input state's structure, shapes and
+        dtypes, so it is donation-safe under `jax.jit(..., donate_argnums=...)`.
+        """
         if params is None:
             raise ValueError(base.NO_PARAMS_MSG)
 
@@ -8,7 +8,7 @@
 import jax
 import jax.numpy as jnp
 
-from flora_opt.optimizers.optax.flora import random_generate
+from flora_opt.optimizers.optax.flora import ScaleByFloraState, random_generate, scale_by_flora
 
 
 def test_stable_randn_consistent():
@@ -46,3 +46,43 @@ def test_stable_randn_randomness():
                 assert jnp.allclose(
                     random_generate(jax.random.PRNGKey(prev_seed), shape, jnp.float32), results[prev_seed]
                 )
+
+
+def test_scale_by_flora_grouped_update_matches_single_leaf():
+    with jax.default_device(jax.devices("cpu")[0]):
+        params = {
+            "attn_1": jnp.ones((256, 256)),  # vmapped group of two
+            "attn_2": jnp.ones((256, 256)),
+            "ff": jnp.ones((256, 512)),  # singleton factorized leaf
+            "bias": jnp.ones((32,)),  # unfactorized leaf
+        }
+        grads = {
+            k: jax.random.normal(jax.random.PRNGKey(i), p.shape) for i, (k, p) in enumerate(sorted(params.items()))
+        }
+
+        tx = scale_by_flora(beta=0.9, tau=8)
+        state = tx.init(params)
+        updates, new_state = tx.update(grads, state, params)
+
+        # The update preserves tree structure, shapes and dtypes.
+        assert jax.tree_util.tree_structure(new_state) == jax.tree_util.tree_structure(state)
+        for old, new in zip(jax.tree_util.tree_leaves(state), jax.tree_util.tree_leaves(new_state)):
+            assert old.shape == new.shape
+            assert old.dtype == new.dtype
+        for name in params:
+            assert updates[name].shape == params[name].shape
+            assert updates[name].dtype == params[name].dtype
+
+        # Each leaf agrees with the single-leaf (unbatched) path, which uses
+        # the same per-leaf keys when given the corresponding state slice.
+        for name in params:
+            sub_state = ScaleByFloraState(
+                count=state.count,
+                decomposition={name: state.decomposition[name]},
+                rng=state.rng,
+            )
+            sub_updates, _ = tx.update({name: grads[name]}, sub_state, {name: params[name]})
+
+            scale = jnp.max(jnp.abs(sub_updates[name])) + 1e-6
+            # bf16 tolerance: batched matmuls may round differently.
+            assert jnp.max(jnp.abs(updates[name] - sub_updates[name])) / scale < 1e-2